@@ -219,7 +219,7 @@ def decode_text(
                 GenerationStates(
                     new_input_ids=batch.input_ids,
                     new_input_mask=batch.input_masks,
-                    store=Store(),
+                    store=Store(max_new_tokens=max_new_tokens),
                     generation_ids=[batch.input_ids],
                     generation_mask=[batch.input_masks],
                 )
@@ -307,7 +307,7 @@ def decode_text(
                         else:
                             raise NotImplementedError(f"Sampler type {sampler_type} is not implemented")
 
-                        new_decoder_input_ids = sampler(sharded_logits=sharded_logits[:, -1, :])
+                        new_decoder_input_ids = sampler(sharded_logits=sharded_logits[:, -1, :].float())
 
                         # TODO @thomasw21: Handle this correctly, ie from some point after <eos> this should only generate masked tokens
                         # TODO @thomasw21: Actually I can probably build this thing on the next device directly. Will save some communication
@@ -548,7 +548,7 @@ def decode_tokenized(
                 GenerationStates(
                     new_input_ids=batch.input_ids,
                     new_input_mask=batch.input_masks,
-                    store=Store(),
+                    store=Store(max_new_tokens=max_new_tokens),
                     generation_ids=[batch.input_ids],
                     generation_mask=[batch.input_masks],
                 )
@@ -624,7 +624,7 @@ def decode_tokenized(
                         else:
                             raise NotImplementedError(f"Sampler type {sampler_type} is not implemented")
 
-                        new_decoder_input_ids = sampler(sharded_logits=sharded_logits[:, -1, :])
+                        new_decoder_input_ids = sampler(sharded_logits=sharded_logits[:, -1, :].float())
 
                         # TODO @thomasw21: Handle this correctly, ie from some point after <eos> this should only generate masked tokens
                         # TODO @thomasw21: Actually I can probably build this thing on the next device directly. Will save some communication
@@ -1,5 +1,6 @@
 import collections
 import contextlib
+from typing import Optional
 
 from torch import nn
 
@@ -10,8 +11,10 @@ class Store(collections.defaultdict):
     This is useful at inference if we don't want to recompute kv_cache for example, or that we don't want to communicate it through the pipeline
     """
 
-    def __init__(self):
+    def __init__(self, max_new_tokens: Optional[int] = None):
         super().__init__(dict)
+        # Number of tokens generated after the prompt, if known, so that modules can size their caches up front
+        self.max_new_tokens = max_new_tokens
 
     def flush(self):
         # TODO @thomasw21: There's probably a simpler way than doing this.
@@ -35,6 +38,10 @@ class AttachableStore:
         else:
             return None
 
+    def get_global_store(self) -> Optional[Store]:
+        """Returns the store shared by all modules, eg to read `Store.max_new_tokens`"""
+        return getattr(self, "_store", None)
+
 
 @contextlib.contextmanager
 def attach_store(model: nn.Module, store: Store):
@@ -179,22 +179,27 @@ def build_model(
 
         # Balance compute across PP blocks
         block_compute_costs = model.get_block_compute_costs()
-        block_cumulative_costs = np.cumsum(
-            [
-                block_compute_costs[module.module_builder] if module.module_builder in block_compute_costs else 0
-                for module in pipeline_blocks
-            ]
-        )
+        block_costs = [
+            block_compute_costs[module.module_builder] if module.module_builder in block_compute_costs else 0
+            for module in pipeline_blocks
+        ]
+        block_cumulative_costs = np.cumsum(block_costs)
 
         thresholds = [block_cumulative_costs[-1] * ((rank + 1) / pp_size) for rank in range(pp_size)]
         assert thresholds[-1] >= block_cumulative_costs[-1]
         target_pp_rank_idx = 0
-        for block, cumulative_cost in zip(pipeline_blocks, block_cumulative_costs):
+        move_to_next_rank = False
+        for block, cost, cumulative_cost in zip(pipeline_blocks, block_costs, block_cumulative_costs):
+            # Blocks without compute cost (eg the loss) stay on the rank of the block before them, which produces their
+            # inputs, instead of starting the next rank
+            if move_to_next_rank and cost > 0:
+                target_pp_rank_idx += 1
+                move_to_next_rank = False
             assert target_pp_rank_idx < pp_size
             block.build_and_set_rank(target_pp_ranks[target_pp_rank_idx])
 
             if cumulative_cost > thresholds[target_pp_rank_idx]:
-                target_pp_rank_idx += 1
+                move_to_next_rank = True
 
         model.input_pp_rank = target_pp_ranks[0]
         model.output_pp_rank = target_pp_ranks[target_pp_rank_idx]
@@ -14,16 +14,21 @@
 # limitations under the License.
 """ PyTorch LLaMa model.
 """
+from functools import cached_property, lru_cache
 from typing import Dict, Optional, Union
 import math
 import torch
 from flash_attn import bert_padding
 from flash_attn.flash_attn_interface import (
     flash_attn_varlen_func,
+    flash_attn_varlen_kvpacked_func,
+    flash_attn_varlen_qkvpacked_func,
     flash_attn_with_kvcache,
 )
 from flash_attn.layers.rotary import RotaryEmbedding as FlashRotaryEmbedding
+from flash_attn.ops.activations import swiglu
 from torch import nn
+from torch.nn import functional as F
 
 from nanotron import distributed as dist
 from nanotron import logging
@@ -40,7 +45,7 @@ from nanotron.parallel.pipeline_parallel.block import (
     TensorPointer,
 )
 from nanotron.parallel.pipeline_parallel.p2p import P2P
-from nanotron.parallel.tensor_parallel.functional import sharded_cross_entropy
+from nanotron.parallel.tensor_parallel.functional import sharded_linear_cross_entropy
 from nanotron.parallel.tensor_parallel.nn import (
     TensorParallelColumnLinear,
     TensorParallelEmbedding,
@@ -52,6 +57,9 @@ from nanotron.utils import checkpoint_method
 
 logger = logging.get_logger(__name__)
 
+# flash-attn requires the block size of a paged KV cache to be divisible by 256
+KV_CACHE_BLOCK_SIZE = 256
+
 
 class RotaryEmbedding(nn.Module):
     def __init__(self, dim: int, end: int, theta: float = 10000.0):
@@ -60,77 +68,106 @@ class RotaryEmbedding(nn.Module):
         self.dim = dim
         self.end = end
         self.theta = theta
+        # Tables are computed in fp32, but stored in the activation dtype to halve the bytes gathered at each forward.
+        # The activation dtype is only known from the inputs, so it's set by `maybe_resize`.
+        self.dtype: Optional[torch.dtype] = None
         # TODO @nouamane: Figure out why we can't set `DTypeInvariantTensor` ...
-        # TODO @thomasw21: Complex buffers break DDP, instead we store float and view them as complex
-        self.freqs_cis: torch.Tensor
+        # NOTE: We store real-valued cos/sin tables instead of complex `freqs_cis`, so that the rotation can run in the
+        # activation dtype (there are no bf16 complex tensors) and the tables can be passed as is to flash-attn.
+        self.cos: torch.Tensor
+        self.sin: torch.Tensor
         self._initialized_buffer = False
 
     def init_rotary_embeddings(self):
         if self._initialized_buffer is True:
             # Buffer if already initialized
             return
+        if self.dtype is None:
+            # Initialized before any input, the tables are re-initialized if the inputs turn out to have another dtype
+            self.dtype = torch.float
+        self.register_buffer(
+            "cos",
+            torch.empty(self.end, self.dim // 2, dtype=self.dtype, device="cuda"),
+            persistent=False,
+        )
         self.register_buffer(
-            "freqs_cis",
-            torch.empty(self.end, self.dim // 2, 2, dtype=torch.float, device="cuda"),
+            "sin",
+            torch.empty(self.end, self.dim // 2, dtype=self.dtype, device="cuda"),
             persistent=False,
         )
-        assert self.freqs_cis.device.type == "cuda"
+        assert self.cos.device.type == "cuda"
         # TODO @nouamane: One we figure out how to do the DTypeInvariantTensor, this can be removed and changed to an assert
-        if self.freqs_cis.dtype != torch.float:
-            self.freqs_cis = self.freqs_cis.to(torch.float)
-        assert self.freqs_cis.dtype == torch.float
+        if self.cos.dtype != self.dtype:
+            self.cos = self.cos.to(self.dtype)
+            self.sin = self.sin.to(self.dtype)
+        assert self.cos.dtype == self.dtype
         freqs = 1.0 / (
             self.theta
             ** (torch.arange(0, self.dim, 2, dtype=torch.float, device="cuda")[: (self.dim // 2)] / self.dim)
         )
         t = torch.arange(self.end, device="cuda")
         freqs = torch.outer(t, freqs).float()
-        complex_freqs = torch.polar(torch.ones_like(freqs), freqs)
-        freqs = torch.view_as_real(complex_freqs)
-        self.freqs_cis.copy_(freqs)
+        self.cos.copy_(torch.cos(freqs))
+        self.sin.copy_(torch.sin(freqs))
         self._initialized_buffer = True
 
+    def maybe_resize(self, seq_length: int, dtype: torch.dtype):
+        """Enlarge (and initialize) the buffers so that they cover positions up to `seq_length`, in `dtype`.
+
+        NOTE: `seq_length` is a host-side upper bound of the position ids, reading them would force a cpu-gpu sync.
+        """
+        if dtype != self.dtype:
+            self.dtype = dtype
+            self._initialized_buffer = False
+        while seq_length >= self.end:
+            self.end *= 2
+            self._initialized_buffer = False
+        if self._initialized_buffer is False:
+            log_rank(
+                f"Initializing rotary embeddings with end={self.end} and dtype={self.dtype}",
+                logger=logger,
+                level=logging.DEBUG,
+                rank=0,
+            )
+            self.init_rotary_embeddings()
+
     def forward(
         self,
         x: torch.Tensor,  # [batch_size, seq_length, num_heads, d_qk]
         position_ids: Optional[torch.LongTensor],  # [batch_size, seq_length]
     ):
         batch_size, seq_length, num_heads, inner_dim = x.shape
-        while (
-            position_ids is not None and position_ids[-1, -1] >= self.end
-        ) or seq_length >= self.end:  # TODO @nouamane: check if this causes cpu-gpu sync
-            self.end *= 2
-            self._initialized_buffer = False
-        if self._initialized_buffer is False:
-            print(f"Initializing rotary embeddings with end={self.end}")
-            self.init_rotary_embeddings()
-        dtype = x.dtype
+        # NOTE: Position ids are expected to be smaller than `seq_length`, as is the case during prefill
+        self.maybe_resize(seq_length=seq_length, dtype=x.dtype)
         assert inner_dim % 2 == 0
-        x = x.view(
-            batch_size, seq_length, num_heads, inner_dim // 2, 2
-        )  # [batch_size, q_length, num_heads, inner_dim]
-        if x.dtype == torch.bfloat16:
-            x = x.float()
-        complex_x = torch.view_as_complex(x)  # [batch_size, q_length, num_heads, inner_dim // 2]
+        # Rotate pairs of adjacent dimensions, ie (x_{2i}, x_{2i+1}), in the dtype of `x`
+        x = x.view(batch_size, seq_length, num_heads, inner_dim // 2, 2)
+        x1, x2 = x[..., 0], x[..., 1]  # [batch_size, q_length, num_heads, inner_dim // 2]
         if position_ids is None:
-            freqs_cis = self.freqs_cis[None, :seq_length, None, :]
+            cos = self.cos[None, :seq_length, None, :]
+            sin = self.sin[None, :seq_length, None, :]
         else:
             # TODO(kunhao): Should None follow the num_heads dimension?
-            if position_ids[-1, -1] < 0 or position_ids[-1, -1] >= self.end:  # Quick test hopefully
-                raise ValueError(f"Position ids must be in the range [0, {self.end}), but got {position_ids}")
-            freqs_cis = self.freqs_cis[position_ids][:, :, None, :]
-        complex_freqs = torch.view_as_complex(freqs_cis)
-        x_out = torch.view_as_real(complex_x * complex_freqs).view(batch_size, seq_length, num_heads, inner_dim)
-        return x_out.type(dtype)
+            # Checked on device, raising on the host would wait for `position_ids` to be computed. Only the upper bound
+            # is checked: rows that are entirely padding have position ids of -1, which are valid inputs.
+            torch._assert_async((position_ids[:, -1] < self.end).all())
+            cos = self.cos[position_ids][:, :, None, :]
+            sin = self.sin[position_ids][:, :, None, :]
+        x_out = torch.stack([x1 * cos - x2 * sin, x1 * sin + x2 * cos], dim=-1)
+        return x_out.view(batch_size, seq_length, num_heads, inner_dim)
 
 
 class GLUActivation(nn.Module):
     def __init__(self, act_fn_name: str):
         super().__init__()
         self.act = ACT2FN[act_fn_name]
+        # flash-attn provides a fused `silu(gate) * up` kernel, which avoids materializing `silu(gate)`
+        self.use_fused_swiglu = act_fn_name in ("silu", "swish")
 
     def forward(self, merged_states: torch.Tensor):
         gate_states, up_states = torch.split(merged_states, merged_states.shape[-1] // 2, dim=-1)
+        if self.use_fused_swiglu:
+            return swiglu(gate_states, up_states)
         return self.act(gate_states) * up_states
 
 
@@ -171,7 +208,6 @@ class MLP(nn.Module):
             bias=False,
             async_communication=tp_linear_async_communication and tp_mode is TensorParallelLinearMode.REDUCE_SCATTER,
         )
-        # TODO @nouamane: why can't we torch.jit.script GLUActivation?
         self.split_silu_mul = GLUActivation(config.hidden_act)
 
     def forward(self, hidden_states):  # [seq_length, batch_size, hidden_dim]
@@ -180,6 +216,17 @@ class MLP(nn.Module):
         return {"hidden_states": hidden_states}
 
 
+def get_cu_seqlens(sequence_mask: torch.Tensor) -> torch.Tensor:
+    """Cumulative sequence lengths as expected by `flash_attn_varlen_func`.
+    Args:
+        sequence_mask: (batch_size, seqlen)
+    Returns:
+        cu_seqlens: (batch_size + 1,) torch.int32
+    """
+    seqlens = sequence_mask.sum(-1, dtype=torch.int32)
+    return F.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+
+
 class CoreAttention(nn.Module):
     def __init__(self, config: LlamaConfig, parallel_config: Optional[ParallelismArgs], layer_idx: int):
         super().__init__()
@@ -196,24 +243,25 @@ class CoreAttention(nn.Module):
     def forward(
         self,
         query_states: torch.Tensor,  # [batch_size * q_length, n_local_q_heads, inner_dim]
-        key_states: torch.Tensor,  # [batch_size * kv_length, n_local_kv_heads, inner_dim]
-        value_states: torch.Tensor,  # [batch_size * kv_length, n_local_kv_heads, inner_dim]
+        key_value_states: torch.Tensor,  # [batch_size * kv_length, 2, n_local_kv_heads, inner_dim]
         q_sequence_mask: torch.Tensor,  # torch.BoolTensor [batch_size, q_length] (can be broadcasted to that size)
         kv_sequence_mask: torch.Tensor,  # torch.BoolTensor [batch_size, kv_length] (can be broadcasted to that size)
+        cu_seqlens_q: Optional[torch.Tensor] = None,  # torch.IntTensor [batch_size + 1]
+        cu_seqlens_k: Optional[torch.Tensor] = None,  # torch.IntTensor [batch_size + 1]
     ):
-        # TODO @thomasw21: Compute once, instead of computing for each layers.
-        cu_seqlens_q = torch.zeros((q_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
-        cu_seqlens_k = torch.zeros((kv_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
-        torch.cumsum(q_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_q[1:])
-        torch.cumsum(kv_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_k[1:])
+        # NOTE: `LlamaModel` computes `cu_seqlens` once per micro-batch and threads it through the decoder layers.
+        if cu_seqlens_q is None:
+            cu_seqlens_q = get_cu_seqlens(q_sequence_mask)
+        if cu_seqlens_k is None:
+            cu_seqlens_k = get_cu_seqlens(kv_sequence_mask)
 
         # TODO(kunhao): flash attn's causal means that the query can only attend to the keys before it. This is not
         # what we want if we are using kv cache. This is a hack as we always have q_length == 1 when using kv cache.
         causal = False if q_sequence_mask.shape[1] == 1 else True
-        attn_output = flash_attn_varlen_func(
+        # NOTE: GQA is handled natively by flash-attn, key/value states don't need to be repeated
+        attn_output = flash_attn_varlen_kvpacked_func(
             q=query_states,
-            k=key_states,
-            v=value_states,
+            kv=key_value_states,
             cu_seqlens_q=cu_seqlens_q,
             cu_seqlens_k=cu_seqlens_k,
             max_seqlen_q=q_sequence_mask.shape[1],
@@ -226,33 +274,70 @@ class CoreAttention(nn.Module):
 
         return attn_output
 
+    @checkpoint_method(attr_name="checkpoint_attention")
+    def forward_qkvpacked(
+        self,
+        qkv_states: torch.Tensor,  # [batch_size * q_length, 3, n_local_q_heads, inner_dim]
+        sequence_mask: torch.Tensor,  # torch.BoolTensor [batch_size, q_length] (can be broadcasted to that size)
+        cu_seqlens: Optional[torch.Tensor] = None,  # torch.IntTensor [batch_size + 1]
+    ):
+        """Attention over packed query/key/value states, which share the same heads and sequences (no GQA)."""
+        if cu_seqlens is None:
+            cu_seqlens = get_cu_seqlens(sequence_mask)
+
+        # Same causal hack as in `forward`
+        causal = False if sequence_mask.shape[1] == 1 else True
+        # flash-attn loads the query/key/value states of a head all at once
+        return flash_attn_varlen_qkvpacked_func(
+            qkv=qkv_states,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=sequence_mask.shape[1],
+            dropout_p=0.0,
+            softmax_scale=None,  # This already defaults to the scale I'm interested in
+            causal=causal,
+            return_attn_probs=False,
+        )
+
 
-def pad_to_right(tensor, mask, new_tensor=None):
-    """Transform a left-padded tensor into a right-padded tensor. (Useful for prefilling key/value states)
+def allocate_kv_cache_blocks(block_table, num_used_blocks: int, num_blocks_per_sequence: int):
+    """Hand out the next free blocks of the key/value cache pools, up to `num_blocks_per_sequence` blocks per sequence.
     Args:
-        tensor: (batch_size, seqlen, d1, d2)
-        mask: (batch_size, seqlen)
+        block_table: (batch_size, old_num_blocks_per_sequence), torch.int32 ids of the blocks owned by each sequence
+        num_used_blocks: number of blocks of the pools already handed out, the following ones are free
+        num_blocks_per_sequence: new number of blocks per sequence
+    Returns:
+        block_table: (batch_size, num_blocks_per_sequence)
+        num_used_blocks: new number of blocks handed out
+    """
+    batch_size, old_num_blocks_per_sequence = block_table.shape
+    assert num_blocks_per_sequence >= old_num_blocks_per_sequence
+    num_new_blocks = batch_size * (num_blocks_per_sequence - old_num_blocks_per_sequence)
+    new_block_ids = torch.arange(
+        num_used_blocks, num_used_blocks + num_new_blocks, dtype=torch.int32, device=block_table.device
+    ).view(batch_size, -1)
+    block_table = torch.cat([block_table, new_block_ids], dim=1)
+    return block_table, num_used_blocks + num_new_blocks
+
+
+def pad_to_right(unpad_tensor, indices, position_ids, new_tensor):
+    """Scatter the values of a left-padded tensor into a right-padded tensor. (Useful for prefilling key/value states)
+    Args:
+        unpad_tensor: (total_nnz, d1, d2), as returned by `bert_padding.unpad_input`
+        indices: (total_nnz,), as returned by `bert_padding.unpad_input`
+        position_ids: (batch_size, seqlen), position of each token within its unpadded sequence
         new_tensor: (batch_size, new_tensor_seqlen, d1, d2)
     Returns:
         new_tensor: (batch_size, new_tensor_seqlen, d1, d2)
-        right_padded_mask: (batch_size, seqlen)
     """
-    # First, we need to find the number of padding for each row
-    unpad_seqlens = mask.sum(1)
-    # Then, we need to find the maximum length of the tensor
-    max_seqlen = mask.shape[1]
-    # We can then create the indices to select the padded values
-    # The indices are the same for each row
-    indices = torch.arange(max_seqlen, device=mask.device)
-    # We can then create the mask for the padded values
-    right_padded_mask = indices < unpad_seqlens[:, None]
-    # We select the useful values
-    useful_values = tensor[mask]
-    # We create the new tensor (if not provided)
-    new_tensor = torch.zeros_like(tensor) if new_tensor is None else new_tensor
-    # We fill the new tensor with the useful values
-    new_tensor[:, : right_padded_mask.shape[1], :, :][right_padded_mask] = useful_values
-    return new_tensor, right_padded_mask
+    batch_size, new_tensor_seqlen = new_tensor.shape[:2]
+    # Index of each token in the flattened right-padded tensor. We gather it with `indices` instead of using boolean
+    # indexing, which would require a device to host synchronization.
+    right_padded_indices = (
+        torch.arange(batch_size, device=position_ids.device)[:, None] * new_tensor_seqlen + position_ids
+    )
+    right_padded_indices = right_padded_indices.view(-1)[indices]
+    new_tensor.view(-1, *new_tensor.shape[2:]).index_copy_(0, right_padded_indices, unpad_tensor)
+    return new_tensor
 
 
 class CausalSelfAttention(nn.Module, AttachableStore):
@@ -262,6 +347,8 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         parallel_config: Optional[ParallelismArgs],
         tp_pg: dist.ProcessGroup,
         layer_idx: int,
+        rotary_embedding: RotaryEmbedding,
+        flash_rotary_embedding: FlashRotaryEmbedding,
     ):
         super().__init__()
         # Tensor parallel considerations: We split tensors along head dimension
@@ -314,14 +401,14 @@ class CausalSelfAttention(nn.Module, AttachableStore):
             async_communication=tp_linear_async_communication,
             contiguous_chunks=qkv_contiguous_chunks,
         )
-        # TODO(kunhao): We want to have only one version per device and not one version per layer.
-        self.rotary_embedding = RotaryEmbedding(
-            dim=self.d_qk,
-            end=config.max_position_embeddings,
-        )
+        # NOTE: Shared across all the decoder layers of a PP stage, so we only have one version per device.
+        assert rotary_embedding.dim == self.d_qk
+        self.rotary_embedding = rotary_embedding
 
         # NOTE: Only supported for training (TODO(fmom): position_ids not supported yet)
-        self.flash_rotary_embedding = FlashRotaryEmbedding(dim=self.d_qk, interleaved=True)
+        # Shared as well, so that its cos/sin cache is only built once per device.
+        assert flash_rotary_embedding.dim == self.d_qk
+        self.flash_rotary_embedding = flash_rotary_embedding
 
         self.o_proj = TensorParallelRowLinear(
             config.num_attention_heads * self.d_qk,
@@ -329,7 +416,8 @@ class CausalSelfAttention(nn.Module, AttachableStore):
             pg=tp_pg,
             mode=tp_mode,
             bias=False,
-            async_communication=tp_linear_async_communication,
+            # Same as `MLP.down_proj`: row linears only support async communication in REDUCE_SCATTER mode
+            async_communication=tp_linear_async_communication and tp_mode is TensorParallelLinearMode.REDUCE_SCATTER,
         )
 
         self.attention = CoreAttention(
@@ -338,14 +426,11 @@ class CausalSelfAttention(nn.Module, AttachableStore):
             layer_idx=layer_idx,
         )
 
-        self.prefill_kv_len = (
-            config.max_position_embeddings
-        )  # TODO @nouamane: compute based on free memory, because in rope we can surpass max_position_embeddings
-
     def forward(
         self,
         hidden_states,  # [seq_length, batch_size, hidden_size]
         sequence_mask,  # [batch_size, seq_length]
+        cu_seqlens: Optional[torch.Tensor] = None,  # [batch_size + 1]
     ):
         qkv_states = self.qkv_proj(
             hidden_states
@@ -353,31 +438,26 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         q_length, batch_size, _ = qkv_states.shape
 
         if self.is_gqa:
+            # Transpose the packed qkv states once, then split them into views that don't need to be made contiguous
             query_states, key_states, value_states = torch.split(
-                qkv_states,
+                qkv_states.transpose(0, 1).contiguous(),
                 [
                     self.n_local_q_heads * self.d_qk,
                     self.n_local_kv_heads * self.d_qk,
                     self.n_local_kv_heads * self.d_qk,
                 ],
                 dim=-1,
-            )
+            )  # [batch_size, seq_length, n_local_{q,kv}_heads * d_qk]
 
-            query_states = (
-                query_states.transpose(0, 1).contiguous().view(batch_size, q_length, self.n_local_q_heads, self.d_qk)
-            )
-            key_states = (
-                key_states.transpose(0, 1).contiguous().view(batch_size, q_length, self.n_local_kv_heads, self.d_qk)
-            )
-            value_states = (
-                value_states.transpose(0, 1).contiguous().view(batch_size, q_length, self.n_local_kv_heads, self.d_qk)
-            )
+            query_states = query_states.view(batch_size, q_length, self.n_local_q_heads, self.d_qk)
+            key_states = key_states.view(batch_size, q_length, self.n_local_kv_heads, self.d_qk)
+            value_states = value_states.view(batch_size, q_length, self.n_local_kv_heads, self.d_qk)
         else:
-            query_states, key_states, value_states = (
-                qkv_states.view(q_length, batch_size, 3, self.n_local_q_heads, self.d_qk)
-                .permute(2, 1, 0, 3, 4)
-                .contiguous()
-            )  # [3, batch_size, seq_length, n_local_q_heads, d_qk]
+            # Keep query/key/value states packed, training feeds them to `flash_attn_varlen_qkvpacked_func` as is
+            qkv_states = (
+                qkv_states.view(q_length, batch_size, 3, self.n_local_q_heads, self.d_qk).transpose(0, 1).contiguous()
+            )  # [batch_size, seq_length, 3, n_local_q_heads, d_qk]
+            query_states, key_states, value_states = qkv_states.unbind(dim=2)
 
         store = self.get_local_store()
         if store is not None:  # Inference case
@@ -389,13 +469,9 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                 position_ids = old_position_offsets[:, None] + sequence_mask
             else:
                 position_ids = torch.cumsum(sequence_mask, dim=-1, dtype=torch.int32) - 1
-            position_offsets = position_ids[:, -1]
-
-            # Compute rotary embeddings
-            # Note: keep track of old rotary embedding end to check if we need to enlarge k_cache and v_cache
-            old_rotary_embed_end = self.rotary_embedding.end
-            query_states = self.rotary_embedding(query_states, position_ids=position_ids)
-            key_states = self.rotary_embedding(key_states, position_ids=position_ids)
+            # Made contiguous once here, as `flash_attn_with_kvcache` expects for `cache_seqlens`. This is a no-op
+            # during decoding, where `position_ids` is [batch_size, 1].
+            position_offsets = position_ids[:, -1].contiguous()
 
             if "key" not in store:
                 # First inference iteration (Prefill)
@@ -406,22 +482,10 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     sequence_mask[:, :-1] & (~sequence_mask[:, 1:])  # True is never followed by False
                 ).any(), "Can't mask in the middle of sequence, please make sure that pads are at the left of the sequence if existing"
 
-                # preallocate k_cache, v_cache to self.prefill_kv_len
-                k_cache = torch.zeros(
-                    (
-                        batch_size,
-                        self.prefill_kv_len,
-                        self.n_local_kv_heads,
-                        self.d_qk,
-                    ),
-                    dtype=query_states.dtype,
-                    device=query_states.device,
-                )
-                v_cache = torch.zeros(
-                    (batch_size, self.prefill_kv_len, self.n_local_kv_heads, self.d_v),
-                    dtype=query_states.dtype,
-                    device=query_states.device,
-                )
+                # Compute rotary embeddings
+                query_states = self.rotary_embedding(query_states, position_ids=position_ids)
+                key_states = self.rotary_embedding(key_states, position_ids=position_ids)
+
                 # Remove pad tokens from key_states and concatenate samples in key_unpad
                 # cu_seqlens_k is the cumulative sequence lengths of key_states
                 (query_unpad, indices_q, cu_seqlens_q, max_seqlen_q) = bert_padding.unpad_input(
@@ -451,8 +515,41 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     output_unpad, indices_q, batch_size, q_length
                 )  # (batch_size, q_length, n_local_q_heads, d_v)
 
-                pad_to_right(key_states, sequence_mask, new_tensor=k_cache)
-                pad_to_right(value_states, sequence_mask, new_tensor=v_cache)
+                # Preallocate pools of blocks for k_cache, v_cache, large enough for the prompt and the tokens that
+                # will be generated, if the store knows how many. Only the blocks covering the prompt are handed out,
+                # the others are handed out during decoding so the blocks already in use never have to be copied.
+                # NOTE: No need to zero them, `pad_to_right` fills the valid positions and `flash_attn_with_kvcache`
+                # only reads the first `cache_seqlens` positions of each sequence
+                max_cache_seqlen = q_length
+                pool_seqlen = q_length
+                if self.get_global_store().max_new_tokens is not None:
+                    pool_seqlen += self.get_global_store().max_new_tokens
+                num_pool_blocks = batch_size * math.ceil(pool_seqlen / KV_CACHE_BLOCK_SIZE)
+                k_cache = query_states.new_empty(
+                    (num_pool_blocks, KV_CACHE_BLOCK_SIZE, self.n_local_kv_heads, self.d_qk)
+                )
+                v_cache = query_states.new_empty(
+                    (num_pool_blocks, KV_CACHE_BLOCK_SIZE, self.n_local_kv_heads, self.d_v)
+                )
+                block_table, num_used_blocks = allocate_kv_cache_blocks(
+                    block_table=torch.empty((batch_size, 0), dtype=torch.int32, device=query_states.device),
+                    num_used_blocks=0,
+                    num_blocks_per_sequence=math.ceil(max_cache_seqlen / KV_CACHE_BLOCK_SIZE),
+                )
+                # Blocks are handed out in sequence order at prefill, so the used blocks can be viewed as
+                # [batch_size, num_blocks_per_sequence * block_size, ...] to be filled in.
+                pad_to_right(
+                    key_unpad,
+                    indices_k,
+                    position_ids,
+                    new_tensor=k_cache[:num_used_blocks].view(batch_size, -1, *k_cache.shape[2:]),
+                )
+                pad_to_right(
+                    value_unpad,
+                    indices_k,
+                    position_ids,
+                    new_tensor=v_cache[:num_used_blocks].view(batch_size, -1, *v_cache.shape[2:]),
+                )
 
             else:
                 # Pull pre-computed key/value states
@@ -461,48 +558,35 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                 v_cache = store["value"]
 
                 # NOTE(fmom): According to flash_attn_with_kvcache, "If you pass in k / v, you must make sure that the cache is large enough to hold the new values"
-                # Since rotary embedding has changed (to enable larger context), we need to enlarge k_cache and v_cache
-                if self.rotary_embedding.end > old_rotary_embed_end:
-                    k_cache = torch.cat(
-                        [
-                            k_cache,
-                            torch.zeros(
-                                (
-                                    batch_size,
-                                    self.rotary_embedding.end - old_rotary_embed_end,
-                                    self.n_local_kv_heads,
-                                    self.d_qk,
-                                ),
-                                dtype=query_states.dtype,
-                                device=query_states.device,
-                            ),
-                        ],
-                        dim=1,
+                # `max_cache_seqlen` is tracked on the host as an upper bound of `cache_seqlens`, to avoid a sync
+                max_cache_seqlen = store["max_cache_seqlen"] + q_length
+
+                block_table = store["block_table"]
+                num_used_blocks = store["num_used_blocks"]
+                if max_cache_seqlen > block_table.shape[1] * KV_CACHE_BLOCK_SIZE:
+                    block_table, num_used_blocks = allocate_kv_cache_blocks(
+                        block_table=block_table,
+                        num_used_blocks=num_used_blocks,
+                        num_blocks_per_sequence=math.ceil(max_cache_seqlen / KV_CACHE_BLOCK_SIZE),
                     )
-
-                    v_cache = torch.cat(
-                        [
-                            v_cache,
-                            torch.zeros(
-                                (
-                                    batch_size,
-                                    self.rotary_embedding.end - old_rotary_embed_end,
-                                    self.n_local_kv_heads,
-                                    self.d_v,
-                                ),
-                                dtype=query_states.dtype,
-                                device=query_states.device,
-                            ),
-                        ],
-                        dim=1,
-                    )
-
-                assert (
-                    k_cache.shape[1] == self.rotary_embedding.end
-                ), f"Cache size {k_cache.shape[1]} is smaller than rotary embedding end {self.rotary_embedding.end}"
-                assert (
-                    v_cache.shape[1] == self.rotary_embedding.end
-                ), f"Cache size {v_cache.shape[1]} is smaller than rotary embedding end {self.rotary_embedding.end}"
+                    if num_used_blocks > k_cache.shape[0]:
+                        # Only happens past the generation budget the pools were sized for: they are full, so we double
+                        # them
+                        num_new_pool_blocks = max(k_cache.shape[0], num_used_blocks - k_cache.shape[0])
+                        k_cache = torch.cat(
+                            [k_cache, k_cache.new_empty((num_new_pool_blocks, *k_cache.shape[1:]))], dim=0
+                        )
+                        v_cache = torch.cat(
+                            [v_cache, v_cache.new_empty((num_new_pool_blocks, *v_cache.shape[1:]))], dim=0
+                        )
+
+                # Rotary embeddings are applied to query/key states within `flash_attn_with_kvcache`, at position
+                # `cache_seqlens`. We only need to make sure that the cos/sin tables are large enough: with a paged
+                # cache, flash-attn expects them to cover every position of the blocks of a sequence, not only
+                # `max_cache_seqlen`.
+                self.rotary_embedding.maybe_resize(
+                    seq_length=block_table.shape[1] * KV_CACHE_BLOCK_SIZE - 1, dtype=query_states.dtype
+                )
 
                 # [batch_size, seq_length, num_heads, d_qk]
                 query_states = query_states.view(
@@ -522,19 +606,23 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     v_cache,
                     key_states,
                     value_states,
-                    rotary_cos=None,
-                    rotary_sin=None,
+                    rotary_cos=self.rotary_embedding.cos,
+                    rotary_sin=self.rotary_embedding.sin,
                     # TODO @nouamane: seems like this doesnt help to indicate padding in (for first iteration it's just 0)
-                    cache_seqlens=position_offsets.contiguous(),
+                    cache_seqlens=position_offsets,
+                    block_table=block_table,
                     softmax_scale=None,
                     causal=True,
-                    rotary_interleaved=False,  # GPT-NeoX style
+                    rotary_interleaved=True,  # Same as `RotaryEmbedding`, which rotates pairs of adjacent dimensions
                 )
 
             store.update(
                 {
                     "key": k_cache,  # flash-attn has updated with new key_states using cache_seqlens
                     "value": v_cache,
+                    "block_table": block_table,
+                    "num_used_blocks": num_used_blocks,
+                    "max_cache_seqlen": max_cache_seqlen,
                     "position_offsets": position_offsets,
                 }
             )
@@ -543,45 +631,49 @@ class CausalSelfAttention(nn.Module, AttachableStore):
             # Apply rotary embeddings to query/key states
             # NOTE: The layout is different from models/llama.py which is [batch_size, num_heads, seq_length, d_qk]
             # Here it is, [batch_size, seq_length, num_heads, d_qk]
-            # [2, batch_size, seq_length, num_heads, d_qk]
-            key_value_states = torch.cat([key_states.unsqueeze(0), value_states.unsqueeze(0)], dim=0)
-            # [batch_size, seq_length, 2, num_heads, d_qk]
-            key_value_states = key_value_states.permute(1, 2, 0, 3, 4).contiguous()
-            query_states, key_value_states = self.flash_rotary_embedding(query_states, kv=key_value_states)
-            # [batch_size, seq_length, num_heads, d_qk]
-            key_states, value_states = torch.split(key_value_states, 1, dim=2)
-
-            q_sequence_mask = sequence_mask
-            kv_sequence_mask = sequence_mask
-
-            kv_length = key_states.shape[1]
-            # [batch_size, seq_length, num_heads, d_qk]
-            # Shaping for use in `flash-attn` version of flash-attn: `flash_attn_unpadded_func`
-            query_states = query_states.view(
-                batch_size * q_length, self.n_local_q_heads, self.d_qk
-            )  # [batch_size * q_length, self.n_heads, d_qk]
-
-            key_states = key_states.view(
-                batch_size * kv_length, self.n_local_kv_heads, self.d_qk
-            )  # [batch_size * kv_length, self.n_heads, d_qk]
-            value_states = value_states.view(
-                batch_size * kv_length, self.n_local_kv_heads, self.d_v
-            )  # [batch_size * kv_length, self.n_heads, d_v]
-
-            attention_output = self.attention(
-                query_states=query_states,
-                key_states=key_states,
-                value_states=value_states,
-                q_sequence_mask=q_sequence_mask,
-                kv_sequence_mask=kv_sequence_mask,
-            )
+            if self.is_gqa:
+                # [batch_size, seq_length, 2, num_heads, d_qk]
+                key_value_states = torch.stack([key_states, value_states], dim=2)
+                query_states, key_value_states = self.flash_rotary_embedding(query_states, kv=key_value_states)
+
+                kv_length = key_value_states.shape[1]
+                # Shaping for use in `flash-attn` version of flash-attn: `flash_attn_varlen_kvpacked_func`
+                query_states = query_states.view(
+                    batch_size * q_length, self.n_local_q_heads, self.d_qk
+                )  # [batch_size * q_length, self.n_heads, d_qk]
+                # Key/value states are kept packed, which saves splitting them and lets flash-attn load them together
+                key_value_states = key_value_states.view(
+                    batch_size * kv_length, 2, self.n_local_kv_heads, self.d_qk
+                )  # [batch_size * kv_length, 2, self.n_heads, d_qk]
+
+                attention_output = self.attention(
+                    query_states=query_states,
+                    key_value_states=key_value_states,
+                    q_sequence_mask=sequence_mask,
+                    kv_sequence_mask=sequence_mask,
+                    cu_seqlens_q=cu_seqlens,
+                    cu_seqlens_k=cu_seqlens,
+                )
+            else:
+                # Rotary embeddings are applied in place to the query/key parts of the packed qkv states
+                qkv_states = self.flash_rotary_embedding(qkv_states)  # [batch_size, seq_length, 3, num_heads, d_qk]
+                # Shaping for use in `flash-attn` version of flash-attn: `flash_attn_varlen_qkvpacked_func`
+                qkv_states = qkv_states.view(
+                    batch_size * q_length, 3, self.n_local_q_heads, self.d_qk
+                )  # [batch_size * q_length, 3, self.n_heads, d_qk]
+
+                attention_output = self.attention.forward_qkvpacked(
+                    qkv_states=qkv_states,
+                    sequence_mask=sequence_mask,
+                    cu_seqlens=cu_seqlens,
+                )
 
         attention_output = (
             attention_output.contiguous().view(batch_size, q_length, self.n_local_q_heads * self.d_v).transpose(0, 1)
         )
         output = self.o_proj(attention_output)
 
-        return {"hidden_states": output, "sequence_mask": sequence_mask}
+        return {"hidden_states": output, "sequence_mask": sequence_mask, "cu_seqlens": cu_seqlens}
 
 
 class LlamaDecoderLayer(nn.Module):
@@ -591,6 +683,8 @@ class LlamaDecoderLayer(nn.Module):
         parallel_config: Optional[ParallelismArgs],
         tp_pg: dist.ProcessGroup,
         layer_idx: int,
+        rotary_embedding: RotaryEmbedding,
+        flash_rotary_embedding: FlashRotaryEmbedding,
     ):
         super().__init__()
         self.input_layernorm = TritonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
@@ -599,6 +693,8 @@ class LlamaDecoderLayer(nn.Module):
             parallel_config=parallel_config,
             tp_pg=tp_pg,
             layer_idx=layer_idx,
+            rotary_embedding=rotary_embedding,
+            flash_rotary_embedding=flash_rotary_embedding,
         )
 
         self.post_attention_layernorm = TritonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
@@ -608,22 +704,23 @@ class LlamaDecoderLayer(nn.Module):
         self,
         hidden_states: Union[torch.Tensor, TensorPointer],
         sequence_mask: Union[torch.Tensor, TensorPointer],
+        cu_seqlens: Union[torch.Tensor, TensorPointer],
     ) -> Dict[str, Union[torch.Tensor, TensorPointer]]:
         residual = hidden_states
         hidden_states = self.input_layernorm(hidden_states)
 
-        output = self.attn(hidden_states=hidden_states, sequence_mask=sequence_mask)
-        hidden_states = output["hidden_states"]
-        hidden_states = hidden_states + residual
-
-        residual = hidden_states
-        hidden_states = self.post_attention_layernorm(hidden_states)
+        output = self.attn(hidden_states=hidden_states, sequence_mask=sequence_mask, cu_seqlens=cu_seqlens)
+        # Fused residual add + RMSNorm, returns both the normalized states and the new residual
+        hidden_states, residual = self.post_attention_layernorm(
+            output["hidden_states"], residual=residual, prenorm=True
+        )
         hidden_states = self.mlp(hidden_states=hidden_states)["hidden_states"]
         hidden_states = hidden_states + residual
 
         return {
             "hidden_states": hidden_states,
             "sequence_mask": output["sequence_mask"],
+            "cu_seqlens": output["cu_seqlens"],
         }
 
 
@@ -651,10 +748,13 @@ class Embedding(nn.Module, AttachableStore):
             # Store new past_length in store
             store["past_length"] = past_length + cumsum_mask[:, -1]
 
+        # Computed once here and shared by all decoder layers, instead of recomputing it in each `CoreAttention`
+        cu_seqlens = get_cu_seqlens(input_mask)
+
         # Format input in `[seq_length, batch_size]` to support high TP with low batch_size
         input_ids = input_ids.transpose(0, 1)
         input_embeds = self.token_embedding(input_ids)
-        return {"input_embeds": input_embeds}
+        return {"input_embeds": input_embeds, "cu_seqlens": cu_seqlens}
 
 
 class LlamaModel(nn.Module):
@@ -687,7 +787,19 @@ class LlamaModel(nn.Module):
                 "parallel_config": parallel_config,
             },
             module_input_keys={"input_ids", "input_mask"},
-            module_output_keys={"input_embeds"},
+            module_output_keys={"input_embeds", "cu_seqlens"},
+        )
+
+        # Only one rotary embedding per PP stage, shared by all its decoder layers. It is not registered as a submodule
+        # here so that its buffer only gets initialized on ranks that actually build decoder layers.
+        rotary_embedding = RotaryEmbedding(
+            dim=config.hidden_size // config.num_attention_heads,
+            end=config.max_position_embeddings,
+        )
+        # Same for flash-attn's rotary embedding, used in training. Its cos/sin cache is built lazily, so only the
+        # small `inv_freq` buffer exists on every rank. Created on the GPU as it's built outside of `build_model`.
+        flash_rotary_embedding = FlashRotaryEmbedding(
+            dim=config.hidden_size // config.num_attention_heads, interleaved=True, device="cuda"
         )
 
         self.decoder = nn.ModuleList(
@@ -700,9 +812,11 @@ class LlamaModel(nn.Module):
                         "parallel_config": parallel_config,
                         "tp_pg": parallel_context.tp_pg,
                         "layer_idx": layer_idx,
+                        "rotary_embedding": rotary_embedding,
+                        "flash_rotary_embedding": flash_rotary_embedding,
                     },
-                    module_input_keys={"hidden_states", "sequence_mask"},
-                    module_output_keys={"hidden_states", "sequence_mask"},
+                    module_input_keys={"hidden_states", "sequence_mask", "cu_seqlens"},
+                    module_output_keys={"hidden_states", "sequence_mask", "cu_seqlens"},
                 )
                 for layer_idx in range(config.num_hidden_layers)
             ]
@@ -733,14 +847,6 @@ class LlamaModel(nn.Module):
             module_output_keys={"logits"},
         )
 
-        self.cast_to_fp32 = PipelineBlock(
-            p2p=self.p2p,
-            module_builder=lambda: lambda x: x.float(),
-            module_kwargs={},
-            module_input_keys={"x"},
-            module_output_keys={"output"},
-        )
-
     def forward(
         self,
         input_ids: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
@@ -753,27 +859,51 @@ class LlamaModel(nn.Module):
         input_ids: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
         input_mask: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
     ):
-        # all tensors are optional as most ranks don't need anything from the dataloader.
+        hidden_states = self.forward_hidden_states(input_ids=input_ids, input_mask=input_mask)
 
-        output = self.token_position_embeddings(input_ids=input_ids, input_mask=input_mask)
+        # NOTE: Logits are kept in the model dtype, `sharded_cross_entropy` upcasts them to fp32 on the fly
+        sharded_logits = self.lm_head(x=hidden_states)["logits"]
 
-        hidden_encoder_states = {
-            "hidden_states": output["input_embeds"],
-            "sequence_mask": input_mask,
-        }
-        for encoder_block in self.decoder:
-            hidden_encoder_states = encoder_block(**hidden_encoder_states)
+        return sharded_logits, hidden_states
 
-        hidden_states = self.final_layer_norm(input=hidden_encoder_states["hidden_states"])["hidden_states"]
+    def forward_hidden_states(
+        self,
+        input_ids: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
+        input_mask: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
+    ):
+        """Returns the hidden states that are fed to `lm_head`"""
+        # all tensors are optional as most ranks don't need anything from the dataloader.
 
-        sharded_logits = self.lm_head(x=hidden_states)["logits"]
+        output = self.token_position_embeddings(input_ids=input_ids, input_mask=input_mask)
 
-        fp32_sharded_logits = self.cast_to_fp32(x=sharded_logits)["output"]
+        hidden_states = output["input_embeds"]
+        sequence_mask = input_mask
+        cu_seqlens = output["cu_seqlens"]
+        pp_rank = dist.get_rank(self.parallel_context.pp_pg)
+        inputs_are_local = not any(
+            isinstance(tensor, TensorPointer) for tensor in (hidden_states, sequence_mask, cu_seqlens)
+        )
+        for encoder_block in self.decoder:
+            if encoder_block.rank == pp_rank and inputs_are_local:
+                # Fast path: the block runs on this rank and all its inputs are already here, so there is nothing to
+                # send or receive and we can skip the `PipelineBlock` dispatch. Decoder layers pass `sequence_mask` and
+                # `cu_seqlens` through unchanged, so only `hidden_states` needs to be updated.
+                hidden_states = encoder_block.pp_block(hidden_states, sequence_mask, cu_seqlens)["hidden_states"]
+            else:
+                output = encoder_block(hidden_states=hidden_states, sequence_mask=sequence_mask, cu_seqlens=cu_seqlens)
+                hidden_states, sequence_mask, cu_seqlens = (
+                    output["hidden_states"],
+                    output["sequence_mask"],
+                    output["cu_seqlens"],
+                )
+                # Outputs are either all computed on this rank, or all `TensorPointer`s to the block's rank
+                inputs_are_local = encoder_block.rank == pp_rank
 
-        return fp32_sharded_logits, hidden_states
+        return self.final_layer_norm(input=hidden_states)["hidden_states"]
 
-    def get_block_compute_costs(self):
-        """Computes the compute cost of each block in the model so that we can do a better job of load balancing."""
+    @cached_property
+    def block_compute_costs(self):
+        """Compute cost of each block in the model so that we can do a better job of load balancing."""
         model_config = self.config
         d_ff = model_config.intermediate_size
         d_qkv = model_config.hidden_size // model_config.num_attention_heads
@@ -786,6 +916,10 @@ class LlamaModel(nn.Module):
         }
         return block_compute_costs
 
+    def get_block_compute_costs(self):
+        """Computes the compute cost of each block in the model so that we can do a better job of load balancing."""
+        return self.block_compute_costs
+
     def get_flops_per_sec(self, iteration_time_in_sec, sequence_length, global_batch_size):
         """Get flops per second for a given model"""
         world_size = self.parallel_context.world_pg.size()
@@ -810,28 +944,38 @@ class LlamaModel(nn.Module):
         return model_flops_per_s, hardware_flops_per_s
 
 
-@torch.jit.script
-def masked_mean(loss, label_mask, dtype):
-    # type: (Tensor, Tensor, torch.dtype) -> Tensor
+def masked_mean(loss: torch.Tensor, label_mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return (loss * label_mask).sum(dtype=dtype) / label_mask.sum()
 
 
 class Loss(nn.Module):
-    def __init__(self, tp_pg: dist.ProcessGroup):
+    def __init__(self, tp_pg: dist.ProcessGroup, tp_mode: TensorParallelLinearMode, chunk_size: Optional[int] = None):
         super().__init__()
         self.tp_pg = tp_pg
+        self.tp_mode = tp_mode
+        # Number of tokens whose logits are materialized at once, see `sharded_linear_cross_entropy`
+        self.chunk_size = chunk_size
 
     def forward(
         self,
-        sharded_logits: torch.Tensor,  # [seq_length, batch_size, logits]
+        hidden_states: torch.Tensor,  # [seq_length, batch_size, hidden_size]
+        lm_head_weight: torch.Tensor,  # [sharded_vocab_size, hidden_size]
         label_ids: torch.Tensor,  # [batch_size, seq_length]
         label_mask: torch.Tensor,  # [batch_size, seq_length]
     ) -> Dict[str, torch.Tensor]:
         # Megatron by defaults cast everything in fp32. `--f16-lm-cross-entropy` is an option you can use to keep current precision.
         # https://github.com/NVIDIA/Megatron-LM/blob/f267e6186eae1d6e2055b412b00e2e545a8e896a/megatron/model/gpt_model.py#L38
-        loss = sharded_cross_entropy(
-            sharded_logits, label_ids.transpose(0, 1).contiguous(), group=self.tp_pg, dtype=torch.float
-        ).transpose(0, 1)
+        # `lm_head` is fused with the cross entropy, so that the [seq_length, batch_size, vocab_size] logits are never
+        # materialized, only a chunk of them at a time. Labels and loss stay in [batch_size, seq_length] layout.
+        loss = sharded_linear_cross_entropy(
+            hidden_states,
+            lm_head_weight,
+            label_ids,
+            group=self.tp_pg,
+            tp_mode=self.tp_mode,
+            chunk_size=self.chunk_size,
+            dtype=torch.float,
+        )
         # TODO @thomasw21: It's unclear what kind of normalization we want to do.
         loss = masked_mean(loss, label_mask, dtype=torch.float)
         # I think indexing causes a sync we don't actually want
@@ -852,9 +996,10 @@ class LlamaForTraining(NanotronModel):
         self.loss = PipelineBlock(
             p2p=self.model.p2p,
             module_builder=Loss,
-            module_kwargs={"tp_pg": parallel_context.tp_pg},
+            module_kwargs={"tp_pg": parallel_context.tp_pg, "tp_mode": self.model.tp_mode},
             module_input_keys={
-                "sharded_logits",
+                "hidden_states",
+                "lm_head_weight",
                 "label_ids",
                 "label_mask",
             },
@@ -871,12 +1016,21 @@ class LlamaForTraining(NanotronModel):
         label_ids: Union[torch.Tensor, TensorPointer],
         label_mask: Union[torch.Tensor, TensorPointer],
     ) -> Dict[str, Union[torch.Tensor, TensorPointer]]:
-        sharded_logits = self.model(
+        hidden_states = self.model.forward_hidden_states(
             input_ids=input_ids,
             input_mask=input_mask,
         )
+        # The loss computes the logits itself, so it takes the `lm_head` weight. `build_model` places the loss on the
+        # rank of `lm_head`, so the weight is never sent to another rank.
+        lm_head = self.model.lm_head
+        assert self.loss.rank == lm_head.rank, f"Loss is on PP rank {self.loss.rank}, lm_head on {lm_head.rank}"
+        if lm_head.rank == dist.get_rank(self.parallel_context.pp_pg):
+            lm_head_weight = lm_head.pp_block.weight
+        else:
+            lm_head_weight = TensorPointer(group_rank=lm_head.rank)
         loss = self.loss(
-            sharded_logits=sharded_logits,
+            hidden_states=hidden_states,
+            lm_head_weight=lm_head_weight,
             label_ids=label_ids,
             label_mask=label_mask,
         )["loss"]
@@ -898,62 +1052,69 @@ class LlamaForTraining(NanotronModel):
         std = config.model.init_method.std
         sigma = config.model.init_method.std
         num_layers = config.model.model_config.num_hidden_layers
-        
-        for param_name, param in model.named_parameters():
-            assert isinstance(param, NanotronParameter)
-            
-            module_name, param_name = param_name.rsplit('.', 1)
-            
-            if param.is_tied:
-                tied_info = param.get_tied_info()
-                full_param_name = tied_info.get_full_name_from_module_id_to_prefix(
-                    module_id_to_prefix=module_id_to_prefix
-                )
-            else:
-                full_param_name = f"{module_name}.{param_name}"
+        scaled_std = sigma / math.sqrt(2 * num_layers)
 
-            if full_param_name in initialized_parameters:
-                # Already initialized
-                continue
+        # Initialization of each parameter, by module type and parameter name
+        init_methods = {
+            TensorParallelColumnLinear: {
+                "weight": lambda weight: torch.nn.init.normal_(weight, mean=0.0, std=std),
+                "bias": lambda bias: bias.zero_(),
+            },
+            TensorParallelRowLinear: {
+                "weight": lambda weight: torch.nn.init.normal_(weight, mean=0.0, std=scaled_std),
+                "bias": lambda bias: bias.zero_(),
+            },
+            TritonRMSNorm: {
+                # TODO @thomasw21: Sometimes we actually want 0
+                "weight": lambda weight: weight.fill_(1),
+                "bias": lambda bias: bias.zero_(),
+            },
+            TensorParallelEmbedding: {
+                "weight": lambda weight: torch.nn.init.normal_(weight, mean=0.0, std=std),
+            },
+        }
 
-            module = model.get_submodule(module_name)
+        # Full names of the parameters by `id`, so that the name of a tied parameter is only resolved once
+        full_param_names: Dict[int, str] = {}
 
-            if isinstance(module, TensorParallelColumnLinear):
-                if "weight" == param_name:
-                    torch.nn.init.normal_(module.weight, mean=0.0, std=std)
-                elif "bias" == param_name:
-                    module.bias.zero_()
-                else:
-                    raise ValueError(f"Who the fuck is {param_name}?")
-            elif isinstance(module, TensorParallelRowLinear):
-                if "weight" == param_name:
-                    torch.nn.init.normal_(module.weight, mean=0.0, std=sigma / math.sqrt(2 * num_layers))
-                elif "bias" == param_name:
-                    param.zero_()
-                else:
-                    raise ValueError(f"Who the fuck is {param_name}?")
-            elif isinstance(module, TritonRMSNorm):
-                if "weight" == param_name:
-                    # TODO @thomasw21: Sometimes we actually want 0
-                    module.weight.fill_(1)
-                elif "bias" == param_name:
-                    module.bias.zero_()
+        def get_full_param_name(module: nn.Module, param_name: str, param: NanotronParameter) -> str:
+            full_param_name = full_param_names.get(id(param))
+            if full_param_name is None:
+                if param.is_tied:
+                    tied_info = param.get_tied_info()
+                    full_param_name = tied_info.get_full_name_from_module_id_to_prefix(
+                        module_id_to_prefix=module_id_to_prefix
+                    )
                 else:
+                    full_param_name = f"{module_id_to_prefix[id(module)]}{param_name}"
+                full_param_names[id(param)] = full_param_name
+            return full_param_name
+
+        # Single pass over the modules, each of them initializes the parameters it directly owns
+        for module in model.modules():
+            # NOTE: Modules are matched on their exact type, a single dict lookup instead of an `isinstance` per type
+            module_init_methods = init_methods.get(type(module))
+            for param_name, param in module.named_parameters(recurse=False):
+                assert isinstance(param, NanotronParameter)
+
+                full_param_name = get_full_param_name(module, param_name, param)
+                if full_param_name in initialized_parameters:
+                    # Already initialized
+                    continue
+
+                if module_init_methods is None:
+                    raise Exception(f"Parameter {full_param_name} was not intialized")
+                if param_name not in module_init_methods:
                     raise ValueError(f"Who the fuck is {param_name}?")
-            elif isinstance(module, TensorParallelEmbedding):
-                nn.init.normal_(module.weight, mean=0.0, std=std)
-            else:
-                raise Exception(f"Parameter {full_param_name} was not intialized")
-
-            assert full_param_name not in initialized_parameters
-            initialized_parameters.add(full_param_name)
-            
-        assert initialized_parameters == {
-            param.get_tied_info().get_full_name_from_module_id_to_prefix(module_id_to_prefix=module_id_to_prefix)
-            if param.is_tied
-            else name
-            for name, param in model.named_parameters()
-        }, f"Somehow the initialized set of parameters don't match:\n - Expected: { {name for name, _ in model.named_parameters()} }\n - Got: {initialized_parameters}"
+                module_init_methods[param_name](param)
+
+                initialized_parameters.add(full_param_name)
+
+        # Each parameter is initialized under a single name, so counting is enough. The sets of names are only built
+        # to report a mismatch.
+        assert len(initialized_parameters) == sum(
+            1 for _ in model.parameters()
+        ), f"Somehow the initialized set of parameters don't match:\n - Expected: { {full_param_names.get(id(param), name) for name, param in model.named_parameters()} }\n - Got: {initialized_parameters}"
 
     def get_embeddings_lm_head_tied_names(self):
         """Get the names of the tied embeddings and lm_head weights"""
@@ -964,13 +1125,15 @@ class LlamaForTraining(NanotronModel):
 
     def get_block_compute_costs(self):
         """Computes the compute cost of each block in the model so that we can do a better job of load balancing."""
-        return self.model.get_block_compute_costs()
+        return self.model.block_compute_costs
 
     def get_flops_per_sec(self, iteration_time_in_sec, sequence_length, global_batch_size):
         """Get flops per second for a given model"""
         return self.model.get_flops_per_sec(iteration_time_in_sec, sequence_length, global_batch_size)
 
 
+# Only `seq_len` and `batch_size` can change during a run, so the flops are computed once per shape
+@lru_cache(maxsize=8)
 def get_flops(
     num_layers,
     hidden_size,
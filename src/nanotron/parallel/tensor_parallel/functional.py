@@ -36,11 +36,15 @@ class _ShardedCrossEntropy(torch.autograd.Function):
         sharded_logits,  # (batch_size, length, sharded_hidden_size)
         target,  # (batch_size, length)
         group: dist.ProcessGroup,
+        dtype: Optional[torch.dtype] = None,
     ):
+        ctx.logits_dtype = sharded_logits.dtype
         # Maximum value along last dimension across all GPUs.
         logits_max = torch.max(sharded_logits, dim=-1)[0]
+        if dtype is not None:
+            logits_max = logits_max.to(dtype=dtype)
         dist.all_reduce(logits_max, op=dist.ReduceOp.MAX, group=group)
-        # Subtract the maximum value.
+        # Subtract the maximum value. This also upcasts the logits to `dtype` without materializing a casted copy.
         sharded_logits = sharded_logits - logits_max.unsqueeze(dim=-1)
 
         # Get the shard's indices
@@ -67,14 +71,15 @@ class _ShardedCrossEntropy(torch.autograd.Function):
             predicted_logits_1d = predicted_logits_1d.contiguous()
         predicted_logits = predicted_logits_1d.view_as(target)
         predicted_logits[target_mask] = 0.0
-        # All reduce is needed to get the chunks from other GPUs.
-        dist.all_reduce(predicted_logits, op=dist.ReduceOp.SUM, group=group)
 
         # Sum of exponential of logits along vocab dimension across all GPUs.
         exp_logits = sharded_logits
         torch.exp(sharded_logits, out=exp_logits)
         sum_exp_logits = exp_logits.sum(dim=-1)
-        dist.all_reduce(sum_exp_logits, op=dist.ReduceOp.SUM, group=group)
+        # A single all reduce gets both the target logits and the sums of exponentials from other GPUs.
+        predicted_and_sum_exp_logits = torch.stack([predicted_logits, sum_exp_logits])
+        dist.all_reduce(predicted_and_sum_exp_logits, op=dist.ReduceOp.SUM, group=group)
+        predicted_logits, sum_exp_logits = predicted_and_sum_exp_logits
 
         # Loss = log(sum(exp(logits))) - predicted-logit.
         loss = torch.log(sum_exp_logits) - predicted_logits
@@ -105,15 +110,163 @@ class _ShardedCrossEntropy(torch.autograd.Function):
         # Finally elementwise multiplication with the output gradients.
         grad_input.mul_(grad_output.unsqueeze(dim=-1))
 
-        return grad_input, None, None
+        return grad_input.to(dtype=ctx.logits_dtype), None, None, None
 
 
 def sharded_cross_entropy(sharded_logits, target, group: dist.ProcessGroup, dtype: torch.dtype = None):
-    """Helper function for the cross entropy."""
-    if dtype is not None:
-        # Cast input to specific dtype.
-        sharded_logits = sharded_logits.to(dtype=dtype)
-    return _ShardedCrossEntropy.apply(sharded_logits, target, group)
+    """Helper function for the cross entropy.
+
+    If `dtype` is set, the cross entropy is computed in `dtype` (eg fp32 for bf16 logits). The logits are upcast
+    within the kernels, so there is no need to cast them beforehand.
+    """
+    return _ShardedCrossEntropy.apply(sharded_logits, target, group, dtype)
+
+
+class _ShardedLinearCrossEntropy(torch.autograd.Function):
+    """Cross entropy over the logits of a vocab sharded linear layer, without materializing the logits.
+
+    Logits are computed for about `chunk_size` tokens at a time, reduced to a logsumexp and a target logit per token,
+    and recomputed chunk by chunk in the backward pass. Chunks span whole positions, ie `input[start:end]`, so that the
+    (batch_size, length) labels are read through a transposed view instead of being copied to the layout of `input`.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        input,  # (length, batch_size, hidden_size)
+        sharded_weight,  # (sharded_vocab_size, hidden_size)
+        target,  # (batch_size, length)
+        group: dist.ProcessGroup,
+        chunk_size: int,
+        dtype: Optional[torch.dtype] = None,
+    ):
+        length, batch_size, hidden_size = input.shape
+        compute_dtype = dtype if dtype is not None else input.dtype
+        chunk_length = max(1, chunk_size // batch_size)
+
+        # Get the shard's indices
+        sharded_vocab_size = sharded_weight.shape[0]
+        rank = dist.get_rank(group)
+        start_index = rank * sharded_vocab_size
+        end_index = start_index + sharded_vocab_size
+
+        # Create a mask of valid ids (1 means it needs to be masked).
+        target_mask = (target < start_index) | (target >= end_index)
+        masked_target = torch.where(target_mask, 0, target - start_index)
+
+        # Maximum, sum of exponentials and target logit of the shard's logits, for each token. They're stored in the
+        # (length, batch_size) layout of `input`.
+        logits_max = torch.empty(length, batch_size, dtype=compute_dtype, device=input.device)
+        sum_exp_logits = torch.empty_like(logits_max)
+        predicted_logits = torch.empty_like(logits_max)
+        for start in range(0, length, chunk_length):
+            end = min(start + chunk_length, length)
+            # (chunk_length, batch_size, sharded_vocab_size)
+            logits = F.linear(input[start:end], sharded_weight).to(dtype=compute_dtype)
+            chunk_logits_max = torch.max(logits, dim=-1)[0]
+            logits_max[start:end] = chunk_logits_max
+            chunk_target = masked_target[:, start:end].t()
+            predicted_logits[start:end] = torch.gather(logits, -1, chunk_target.unsqueeze(-1)).squeeze(-1)
+            sum_exp_logits[start:end] = torch.exp(logits.sub_(chunk_logits_max.unsqueeze(-1))).sum(-1)
+        predicted_logits.masked_fill_(target_mask.t(), 0.0)
+
+        # Combine the shards' statistics with a single collective of a few values per token: every rank gathers the
+        # maximum, sum of exponentials and target logit of all shards, and reduces them locally
+        shard_stats = torch.stack([logits_max, sum_exp_logits, predicted_logits])
+        if group.size() > 1:
+            stats = torch.empty((group.size(), *shard_stats.shape), dtype=shard_stats.dtype, device=shard_stats.device)
+            dist.all_gather_into_tensor(stats, shard_stats, group=group)
+        else:
+            stats = shard_stats.unsqueeze(0)
+        logits_max, sum_exp_logits, predicted_logits = stats.unbind(dim=1)  # (tp_size, length, batch_size)
+        global_logits_max = torch.max(logits_max, dim=0)[0]
+        sum_exp_logits = (sum_exp_logits * torch.exp(logits_max - global_logits_max)).sum(dim=0)
+        predicted_logits = predicted_logits.sum(dim=0)
+
+        # Loss = log(sum(exp(logits))) - predicted-logit.
+        logsumexp = global_logits_max + torch.log(sum_exp_logits)
+        loss = logsumexp - predicted_logits
+
+        ctx.chunk_length = chunk_length
+        ctx.save_for_backward(input, sharded_weight, masked_target, target_mask, logsumexp)
+
+        # Returned as a (batch_size, length) view, like `target`
+        return loss.t()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, sharded_weight, masked_target, target_mask, logsumexp = ctx.saved_tensors
+        length, batch_size, hidden_size = input.shape
+        sharded_vocab_size = sharded_weight.shape[0]
+        # Viewed in the (length, batch_size) layout of `input`
+        grad_output = grad_output.t()
+        # Gradient of the logits at the target, within this shard
+        target_grad = target_mask.to(dtype=logsumexp.dtype) - 1.0
+
+        grad_input = torch.empty_like(input)
+        # NOTE: The weight gradient is accumulated in place over all chunks, in the weight dtype: an fp32 buffer would
+        # cost another [sharded_vocab_size, hidden_size] fp32 tensor. Each chunk rounds the running sum once, which is
+        # why the default `chunk_size` keeps the number of chunks small.
+        grad_weight = torch.zeros_like(sharded_weight)
+        for start in range(0, length, ctx.chunk_length):
+            end = min(start + ctx.chunk_length, length)
+            chunk_input = input[start:end]
+            # Recompute the logits, and turn them into the gradient of the loss w.r.t. the logits: softmax - one_hot
+            logits = F.linear(chunk_input, sharded_weight).to(dtype=logsumexp.dtype)
+            grad_logits = torch.exp(logits.sub_(logsumexp[start:end].unsqueeze(-1)))
+            grad_logits.scatter_add_(
+                -1, masked_target[:, start:end].t().unsqueeze(-1), target_grad[:, start:end].t().unsqueeze(-1)
+            )
+            grad_logits.mul_(grad_output[start:end].unsqueeze(-1))
+            grad_logits = grad_logits.to(dtype=input.dtype).view(-1, sharded_vocab_size)
+
+            torch.mm(grad_logits, sharded_weight, out=grad_input[start:end].view(-1, hidden_size))
+            grad_weight.addmm_(grad_logits.t(), chunk_input.view(-1, hidden_size))
+
+        return grad_input, grad_weight, None, None, None, None
+
+
+def sharded_linear_cross_entropy(
+    input: torch.Tensor,
+    sharded_weight: torch.Tensor,
+    target: torch.Tensor,
+    group: dist.ProcessGroup,
+    tp_mode: TensorParallelLinearMode,
+    chunk_size: Optional[int] = None,
+    dtype: torch.dtype = None,
+):
+    """Computes the cross entropy of `column_linear(input, sharded_weight)` without materializing the sharded logits.
+
+    Memory trade-off: a chunk holds [chunk_size, sharded_vocab_size] logits (in the input dtype and in `dtype`), and
+    the backward pass needs one [sharded_vocab_size, hidden_size] weight gradient buffer in the weight dtype. Every
+    chunk reads the weight twice and reads and writes the weight gradient buffer once, so small chunks save memory but
+    cost bandwidth and add roundings to the weight gradient. By default, chunks are sized so that their logits have
+    about as many elements as `input`, as in Liger Kernel's fused linear cross entropy.
+
+    Args:
+        input: (length, batch_size, hidden_size), sharded along `length` in `REDUCE_SCATTER` mode
+        sharded_weight: (sharded_vocab_size, hidden_size)
+        target: (batch_size, length)
+        chunk_size: number of tokens whose logits are computed at once (rounded down to a multiple of `batch_size`),
+            derived from the shapes if `None`
+        dtype: dtype in which the cross entropy is computed
+    Returns:
+        loss: (batch_size, length)
+    """
+    if tp_mode is TensorParallelLinearMode.ALL_REDUCE:
+        input = differentiable_identity(input, group=group)
+    elif tp_mode is TensorParallelLinearMode.REDUCE_SCATTER:
+        input = differentiable_all_gather(input, group=group)
+    else:
+        raise ValueError(f"Got unexpected mode: {tp_mode}.")
+
+    if chunk_size is None:
+        sharded_vocab_size, hidden_size = sharded_weight.shape
+        num_tokens = input.shape[0] * input.shape[1]
+        num_chunks = math.ceil(sharded_vocab_size / hidden_size)
+        chunk_size = 1 << (math.ceil(num_tokens / num_chunks) - 1).bit_length()
+
+    return _ShardedLinearCrossEntropy.apply(input, sharded_weight, target, group, chunk_size, dtype)
 
 
 class _ColumnLinearAsyncCommunication(torch.autograd.Function):
@@ -0,0 +1,116 @@
+import math
+
+import pytest
+import torch
+from flash_attn import bert_padding
+from nanotron.models.llama import KV_CACHE_BLOCK_SIZE, allocate_kv_cache_blocks, get_cu_seqlens, pad_to_right
+
+
+def get_left_padded_sequence_mask(seqlens, max_seqlen):
+    seqlens = torch.tensor(seqlens)
+    return torch.arange(max_seqlen)[None, :] >= (max_seqlen - seqlens)[:, None]
+
+
+def mask_based_pad_to_right(tensor, mask, new_tensor):
+    """Boolean mask based implementation of `pad_to_right`, used as a reference"""
+    unpad_seqlens = mask.sum(1)
+    max_seqlen = mask.shape[1]
+    indices = torch.arange(max_seqlen, device=mask.device)
+    right_padded_mask = indices < unpad_seqlens[:, None]
+    useful_values = tensor[mask]
+    new_tensor[:, : right_padded_mask.shape[1], :, :][right_padded_mask] = useful_values
+    return new_tensor, right_padded_mask
+
+
+SEQLENS = [
+    pytest.param([5, 3, 1, 4], 5, id="ragged"),
+    pytest.param([5, 0, 2], 5, id="all_padding_row"),
+    pytest.param([300, 17, 0, 256], 300, id="crosses_block_boundary"),
+]
+
+
+@pytest.mark.parametrize("seqlens,max_seqlen", SEQLENS)
+def test_get_cu_seqlens(seqlens, max_seqlen):
+    sequence_mask = get_left_padded_sequence_mask(seqlens, max_seqlen)
+
+    # Reference: cumsum written into a preallocated zero buffer
+    ref_cu_seqlens = torch.zeros((sequence_mask.shape[0] + 1), dtype=torch.int32)
+    torch.cumsum(sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=ref_cu_seqlens[1:])
+
+    cu_seqlens = get_cu_seqlens(sequence_mask)
+    assert cu_seqlens.dtype == torch.int32
+    torch.testing.assert_close(cu_seqlens, ref_cu_seqlens, atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("seqlens,max_seqlen", SEQLENS)
+def test_pad_to_right(seqlens, max_seqlen):
+    sequence_mask = get_left_padded_sequence_mask(seqlens, max_seqlen)
+    batch_size = sequence_mask.shape[0]
+    num_heads, head_dim = 2, 3
+    key_states = torch.randn(batch_size, max_seqlen, num_heads, head_dim)
+
+    key_unpad, indices, _, _ = bert_padding.unpad_input(key_states, sequence_mask)
+    position_ids = torch.cumsum(sequence_mask, dim=-1, dtype=torch.int32) - 1
+
+    ref_key_states, right_padded_mask = mask_based_pad_to_right(
+        key_states, sequence_mask, new_tensor=torch.zeros_like(key_states)
+    )
+
+    # Fill the blocks handed out at prefill, viewed as a right padded tensor, as in `CausalSelfAttention`
+    num_blocks_per_sequence = math.ceil(max_seqlen / KV_CACHE_BLOCK_SIZE)
+    k_cache = torch.full((2 * batch_size * num_blocks_per_sequence, KV_CACHE_BLOCK_SIZE, num_heads, head_dim), 42.0)
+    block_table, num_used_blocks = allocate_kv_cache_blocks(
+        block_table=torch.empty((batch_size, 0), dtype=torch.int32),
+        num_used_blocks=0,
+        num_blocks_per_sequence=num_blocks_per_sequence,
+    )
+    new_tensor = k_cache[:num_used_blocks].view(batch_size, -1, num_heads, head_dim)
+    output = pad_to_right(key_unpad, indices, position_ids, new_tensor=new_tensor)
+    assert output.data_ptr() == new_tensor.data_ptr()
+
+    # Read the cache back through the block table, the way `flash_attn_with_kvcache` does
+    positions = torch.arange(max_seqlen)
+    paged_key_states = k_cache[
+        block_table[:, positions // KV_CACHE_BLOCK_SIZE].long(), positions % KV_CACHE_BLOCK_SIZE
+    ]
+    torch.testing.assert_close(paged_key_states[right_padded_mask], ref_key_states[right_padded_mask], atol=0, rtol=0)
+    # Padding positions and free blocks are left untouched
+    assert (paged_key_states[~right_padded_mask] == 42.0).all()
+    assert (k_cache[num_used_blocks:] == 42.0).all()
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_allocate_kv_cache_blocks(batch_size):
+    # Prefill of a prompt that crosses a block boundary
+    block_table, num_used_blocks = allocate_kv_cache_blocks(
+        block_table=torch.empty((batch_size, 0), dtype=torch.int32),
+        num_used_blocks=0,
+        num_blocks_per_sequence=math.ceil((KV_CACHE_BLOCK_SIZE + 1) / KV_CACHE_BLOCK_SIZE),
+    )
+    assert block_table.dtype == torch.int32
+    assert num_used_blocks == 2 * batch_size
+    # Blocks are contiguous per sequence, so the used blocks can be viewed as a [batch_size, 2 * block_size] tensor
+    torch.testing.assert_close(
+        block_table, torch.arange(2 * batch_size, dtype=torch.int32).view(batch_size, 2), atol=0, rtol=0
+    )
+
+    # Decoding within the last block doesn't hand out any block
+    new_block_table, new_num_used_blocks = allocate_kv_cache_blocks(
+        block_table=block_table, num_used_blocks=num_used_blocks, num_blocks_per_sequence=2
+    )
+    assert new_num_used_blocks == num_used_blocks
+    torch.testing.assert_close(new_block_table, block_table, atol=0, rtol=0)
+
+    # Decoding across a block boundary hands out the next free blocks, and keeps the blocks already in use
+    new_block_table, new_num_used_blocks = allocate_kv_cache_blocks(
+        block_table=block_table, num_used_blocks=num_used_blocks, num_blocks_per_sequence=3
+    )
+    assert new_num_used_blocks == 3 * batch_size
+    torch.testing.assert_close(new_block_table[:, :2], block_table, atol=0, rtol=0)
+    torch.testing.assert_close(
+        new_block_table[:, 2],
+        torch.arange(num_used_blocks, new_num_used_blocks, dtype=torch.int32),
+        atol=0,
+        rtol=0,
+    )
+    assert new_block_table.unique().numel() == new_block_table.numel()
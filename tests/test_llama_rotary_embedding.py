@@ -0,0 +1,61 @@
+import pytest
+import torch
+from nanotron.models.llama import RotaryEmbedding
+
+
+def get_complex_freqs(dim, end, theta):
+    """`freqs_cis` as built by the complex formulation of rotary embeddings, used as a reference"""
+    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2, dtype=torch.float)[: (dim // 2)] / dim))
+    freqs = torch.outer(torch.arange(end), freqs).float()
+    return torch.polar(torch.ones_like(freqs), freqs)
+
+
+def complex_rotary_embedding(x, freqs_cis, position_ids):
+    """Complex multiply based implementation of `RotaryEmbedding.forward`, used as a reference"""
+    batch_size, seq_length, num_heads, inner_dim = x.shape
+    complex_x = torch.view_as_complex(x.float().view(batch_size, seq_length, num_heads, inner_dim // 2, 2))
+    if position_ids is None:
+        freqs_cis = freqs_cis[None, :seq_length, None, :]
+    else:
+        freqs_cis = freqs_cis[position_ids][:, :, None, :]
+    return torch.view_as_real(complex_x * freqs_cis).view(batch_size, seq_length, num_heads, inner_dim)
+
+
+def init_cpu_rotary_embedding(dim, end, theta, dtype):
+    """`RotaryEmbedding` builds its tables on cuda, so they're set directly to run on cpu"""
+    rotary_embedding = RotaryEmbedding(dim=dim, end=end, theta=theta)
+    freqs_cis = get_complex_freqs(dim, end, theta)
+    rotary_embedding.register_buffer("cos", freqs_cis.real.to(dtype), persistent=False)
+    rotary_embedding.register_buffer("sin", freqs_cis.imag.to(dtype), persistent=False)
+    rotary_embedding.dtype = dtype
+    rotary_embedding._initialized_buffer = True
+    return rotary_embedding
+
+
+@pytest.mark.parametrize(
+    "batch_size,seq_length,num_heads,dim", [(1, 1, 1, 2), (2, 7, 3, 8), (3, 16, 4, 64)], ids=["tiny", "odd", "large"]
+)
+@pytest.mark.parametrize("dtype", [torch.float, torch.bfloat16, torch.float16])
+@pytest.mark.parametrize("with_position_ids", [False, True])
+def test_rotary_embedding_matches_complex_multiply(batch_size, seq_length, num_heads, dim, dtype, with_position_ids):
+    end, theta = 32, 10000.0
+    rotary_embedding = init_cpu_rotary_embedding(dim, end, theta, dtype)
+    x = torch.randn(batch_size, seq_length, num_heads, dim).to(dtype)
+    if with_position_ids:
+        # Arbitrary positions, as during decoding
+        position_ids = torch.randint(low=0, high=end, size=(batch_size, seq_length))
+    else:
+        position_ids = None
+
+    out = rotary_embedding(x, position_ids=position_ids)
+    ref_out = complex_rotary_embedding(x, get_complex_freqs(dim, end, theta), position_ids)
+
+    # The rotation runs in `dtype` with tables stored in `dtype`, whereas the reference runs in fp32
+    assert out.dtype == dtype
+    if dtype is torch.float:
+        tolerances = {}
+    elif dtype is torch.bfloat16:
+        tolerances = {"atol": 2e-2, "rtol": 1.6e-2}
+    else:
+        tolerances = {"atol": 2e-3, "rtol": 1e-3}
+    torch.testing.assert_close(out.float(), ref_out, **tolerances)
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 import pytest
 import torch
@@ -7,12 +8,14 @@ from nanotron import distributed as dist
 from nanotron.distributed import get_global_rank
 from nanotron.parallel import ParallelContext
 from nanotron.parallel.tensor_parallel.enum import TensorParallelLinearMode
+from nanotron.parallel.tensor_parallel.functional import sharded_cross_entropy, sharded_linear_cross_entropy
 from nanotron.parallel.tensor_parallel.nn import (
     TensorParallelColumnLinear,
     TensorParallelEmbedding,
     TensorParallelRowLinear,
 )
 from torch import nn as torch_nn
+from torch.nn import functional as F
 
 
 @pytest.mark.parametrize("tp,dp,pp", [pytest.param(i, 1, 1) for i in range(1, min(4, available_gpus()) + 1)])
@@ -354,3 +357,161 @@ def _test_tensor_parallel_embedding(parallel_context: ParallelContext, tp_mode:
     )
 
     parallel_context.destroy()
+
+
+@pytest.mark.parametrize("tp,dp,pp", [pytest.param(i, 1, 1) for i in range(1, min(4, available_gpus()) + 1)])
+@pytest.mark.parametrize("tp_mode", list(TensorParallelLinearMode))
+@pytest.mark.parametrize("input_dtype", [torch.float, torch.bfloat16])
+# 6 tokens are 2 positions, which don't divide `length` (5 in `ALL_REDUCE` mode), so that the last chunk is partial.
+# `None` uses the chunk size derived from the shapes.
+@pytest.mark.parametrize("chunk_size", [6, None])
+@rerun_if_address_is_in_use()
+def test_sharded_linear_cross_entropy(
+    tp: int, dp: int, pp: int, tp_mode: TensorParallelLinearMode, input_dtype: torch.dtype, chunk_size: Optional[int]
+):
+    init_distributed(tp=tp, dp=dp, pp=pp)(_test_sharded_linear_cross_entropy)(
+        tp_mode=tp_mode, input_dtype=input_dtype, chunk_size=chunk_size
+    )
+
+
+def _test_sharded_linear_cross_entropy(
+    parallel_context: ParallelContext,
+    tp_mode: TensorParallelLinearMode,
+    input_dtype: torch.dtype,
+    chunk_size: Optional[int],
+):
+    hidden_size = 4
+    vocab_size_per_rank = 5
+    vocab_size = parallel_context.tp_pg.size() * vocab_size_per_rank
+    batch_size = 3
+
+    if tp_mode is TensorParallelLinearMode.ALL_REDUCE:
+        length = 5
+    elif tp_mode is TensorParallelLinearMode.REDUCE_SCATTER:
+        length = 5 * parallel_context.tp_pg.size()
+    else:
+        raise ValueError(f"Unsupported mode: {tp_mode}")
+
+    # Generate random inputs, synchronized across tp
+    reference_weight = torch.randn(vocab_size, hidden_size, device="cuda")
+    random_input = torch.randn(length, batch_size, hidden_size, device="cuda")
+    target = torch.randint(low=0, high=vocab_size, size=(batch_size, length), device="cuda")
+    loss_weights = torch.randn(batch_size, length, device="cuda")
+    for tensor in [reference_weight, random_input, target, loss_weights]:
+        dist.broadcast(
+            tensor, src=get_global_rank(group=parallel_context.tp_pg, group_rank=0), group=parallel_context.tp_pg
+        )
+    # The reference runs in fp32 on the values that low precision inputs can represent
+    reference_weight = reference_weight.to(input_dtype).float()
+    random_input = random_input.to(input_dtype).float()
+
+    vocab_dim_slice = slice(
+        dist.get_rank(parallel_context.tp_pg) * vocab_size_per_rank,
+        (dist.get_rank(parallel_context.tp_pg) + 1) * vocab_size_per_rank,
+    )
+    if tp_mode is TensorParallelLinearMode.ALL_REDUCE:
+        length_dim_slice = slice(None)
+    elif tp_mode is TensorParallelLinearMode.REDUCE_SCATTER:
+        sharded_length = length // parallel_context.tp_pg.size()
+        length_dim_slice = slice(
+            dist.get_rank(parallel_context.tp_pg) * sharded_length,
+            (dist.get_rank(parallel_context.tp_pg) + 1) * sharded_length,
+        )
+    else:
+        raise ValueError(f"Unsupported mode: {tp_mode}")
+
+    # It's important that the sharded and reference tensors are seperate tensors with seperate storage
+    sharded_weight = reference_weight[vocab_dim_slice].to(input_dtype)
+    sharded_random_input = random_input[length_dim_slice].to(input_dtype)
+    reference_weight.requires_grad = True
+    random_input.requires_grad = True
+    sharded_weight.requires_grad = True
+    sharded_random_input.requires_grad = True
+
+    # Test that we get the same loss after forward pass
+    sharded_loss = sharded_linear_cross_entropy(
+        sharded_random_input,
+        sharded_weight,
+        target,
+        group=parallel_context.tp_pg,
+        tp_mode=tp_mode,
+        chunk_size=chunk_size,
+        dtype=torch.float,
+    )
+    reference_logits = F.linear(random_input, reference_weight)
+    reference_loss = F.cross_entropy(
+        reference_logits.transpose(0, 1).reshape(-1, vocab_size), target.view(-1), reduction="none"
+    ).view(batch_size, length)
+    # Low precision inputs only change the matmuls, the cross entropy itself is computed in fp32
+    if input_dtype is torch.float:
+        tolerances = {}
+    else:
+        tolerances = {"atol": 1e-2, "rtol": 1.6e-2}
+    torch.testing.assert_close(sharded_loss, reference_loss, **tolerances)
+
+    # Test that we get the same gradient after backward pass
+    (sharded_loss * loss_weights).sum().backward()
+    (reference_loss * loss_weights).sum().backward()
+    assert sharded_weight.grad.dtype == input_dtype
+    assert sharded_random_input.grad.dtype == input_dtype
+    torch.testing.assert_close(sharded_weight.grad.float(), reference_weight.grad[vocab_dim_slice], **tolerances)
+    torch.testing.assert_close(sharded_random_input.grad.float(), random_input.grad[length_dim_slice], **tolerances)
+
+    parallel_context.destroy()
+
+
+@pytest.mark.parametrize("tp,dp,pp", [pytest.param(i, 1, 1) for i in range(1, min(4, available_gpus()) + 1)])
+# Low precision logits are upcast within the cross entropy when passing `dtype`
+@pytest.mark.parametrize("logits_dtype,dtype", [(torch.float, None), (torch.bfloat16, torch.float)])
+@rerun_if_address_is_in_use()
+def test_sharded_cross_entropy(tp: int, dp: int, pp: int, logits_dtype: torch.dtype, dtype: Optional[torch.dtype]):
+    init_distributed(tp=tp, dp=dp, pp=pp)(_test_sharded_cross_entropy)(logits_dtype=logits_dtype, dtype=dtype)
+
+
+def _test_sharded_cross_entropy(
+    parallel_context: ParallelContext, logits_dtype: torch.dtype, dtype: Optional[torch.dtype]
+):
+    vocab_size_per_rank = 5
+    vocab_size = parallel_context.tp_pg.size() * vocab_size_per_rank
+    batch_size = 3
+    length = 4
+
+    # Generate random inputs, synchronized across tp
+    logits = torch.randn(batch_size, length, vocab_size, device="cuda")
+    target = torch.randint(low=0, high=vocab_size, size=(batch_size, length), device="cuda")
+    loss_weights = torch.randn(batch_size, length, device="cuda")
+    for tensor in [logits, target, loss_weights]:
+        dist.broadcast(
+            tensor, src=get_global_rank(group=parallel_context.tp_pg, group_rank=0), group=parallel_context.tp_pg
+        )
+
+    # The reference runs in fp32 on the values that low precision logits can represent
+    logits = logits.to(logits_dtype).float()
+
+    vocab_dim_slice = slice(
+        dist.get_rank(parallel_context.tp_pg) * vocab_size_per_rank,
+        (dist.get_rank(parallel_context.tp_pg) + 1) * vocab_size_per_rank,
+    )
+    # It's important that the sharded and reference tensors are seperate tensors with seperate storage
+    sharded_logits = logits[..., vocab_dim_slice].to(logits_dtype, copy=True)
+    logits.requires_grad = True
+    sharded_logits.requires_grad = True
+
+    # Test that we get the same loss after forward pass
+    sharded_loss = sharded_cross_entropy(sharded_logits, target, group=parallel_context.tp_pg, dtype=dtype)
+    reference_loss = F.cross_entropy(logits.view(-1, vocab_size), target.view(-1), reduction="none").view_as(target)
+    assert sharded_loss.dtype == (dtype if dtype is not None else logits_dtype)
+    torch.testing.assert_close(sharded_loss.float(), reference_loss)
+
+    # Test that we get the same gradient after backward pass
+    (sharded_loss * loss_weights).sum().backward()
+    (reference_loss * loss_weights).sum().backward()
+    # The gradient is cast back to the logits dtype
+    assert sharded_logits.grad.dtype == logits_dtype
+    if logits_dtype is torch.float:
+        tolerances = {}
+    else:
+        tolerances = {"atol": 1e-2, "rtol": 1.6e-2}
+    torch.testing.assert_close(sharded_logits.grad.float(), logits.grad[..., vocab_dim_slice], **tolerances)
+
+    parallel_context.destroy()